@@ -11,22 +11,30 @@
 
 import argparse
 import re
-import gpxpy
-from geopy import distance
-from math import sqrt
+from math import sin, cos, asin, sqrt
+from lxml import etree
 import pandas as pd
 import numpy as np
+from numba import njit, prange
 import datetime
 import dateutil
 import time
-from timezonefinder import TimezoneFinder
+import functools
 
-tzf = TimezoneFinder() 
+# TimezoneFinder is slow to load, so it is only created on first lookup
+tzf = None
 
 # Default target interval lengths if not specified
 default_intervals = ['100m', '1mi', '5mi']
 # If true, ignore altitude data to avoid skewing distances. For e.g. sailing
 use_2d = False
+# Total distance (m) and time (sec) of the track, set by read_gpx. An empty
+# track leaves them at 0 so that every interval is too long for it
+total_distance = 0.0
+total_time = 0.0
+# Elapsed distance and time at each point, set by read_gpx
+distances = np.zeros(0)
+times = np.zeros(0)
 
 #################################################################################
 # Helper class to represent an interval specified with various units
@@ -42,20 +50,21 @@ class Interval:
                 'sec': { 'type' : 'time',     'factor' : 1.0 }, 
                 'min': { 'type' : 'time',     'factor' : 0.0166666667 },
                 'hr' : { 'type' : 'time',     'factor' : 0.0002777778 } }
+  # pattern to split an interval string into value and unit
+  _RE = re.compile('([0-9]+)(' + '|'.join(unit_table.keys()) + ')')
   # construct an interval from a string
   def __init__(self, init_str):
-    for unit in Interval.unit_table.keys():
-       m = re.fullmatch('([0-9]+)' + unit, init_str)
-       if (m):
-          self.value = int(m[1])
-          self.unit = unit
-          self.is_distance = Interval.unit_table[unit]['type'] == 'distance'
-          return
-    valid_units = '|'.join(Interval.unit_table.keys())
-    raise ValueError('interval specification should be NNN.[' + valid_units + ']')
+    m = Interval._RE.fullmatch(init_str)
+    if not m:
+      valid_units = '|'.join(Interval.unit_table.keys())
+      raise ValueError('interval specification should be NNN.[' + valid_units + ']')
+    self.value = int(m[1])
+    self.unit = m[2]
+    self.is_distance = Interval.unit_table[self.unit]['type'] == 'distance'
+    self._normalized = self.value / Interval.unit_table[self.unit]['factor']
   # normalize interval: distance to meters, time to seconds
   def normalize(self):
-    return self.value / Interval.unit_table[self.unit]['factor']
+    return self._normalized
   def __str__(self):
     normalized_units = 'm' if self.is_distance else 'sec'
     return f"{self.value} {self.unit} ({self.normalize():.1f} {normalized_units})"
@@ -90,141 +99,210 @@ def main():
  
   filename = args.filename.name
   read_gpx(filename)
-  for interval in target_intervals:
-    find_best_interval(interval)
+  find_best_intervals(target_intervals)
+
+#################################################################################
+# Great-circle distance in meters between two points given in radians, using
+# the haversine formula on a spherical earth (mean radius)
+@njit(inline='always', fastmath=True, cache=True)
+def _hav(lat1, lon1, lat2, lon2):
+  dlat = lat2 - lat1
+  dlon = lon2 - lon1
+  a = sin(dlat*0.5)**2 + cos(lat1) * cos(lat2) * sin(dlon*0.5)**2
+  return 2 * 6371008.8 * asin(sqrt(a))
+
+# Cumulative distance in meters at each point of a track. lat and lon are in 
+# radians. Point-to-point distance is great-circle, combined with the altitude
+# change unless use_2d is set. Each point-to-point distance is independent, so
+# they are computed in parallel, then accumulated.
+@njit(parallel=True, fastmath=True, cache=True)
+def compute_track(lat, lon, alt, use_2d):
+  n = lat.size
+  delta = np.zeros(n)
+  for i in prange(1, n):
+    d2 = _hav(lat[i-1], lon[i-1], lat[i], lon[i])
+    dh = 0.0 if use_2d else alt[i] - alt[i-1]
+    delta[i] = sqrt(d2*d2 + dh*dh)
+  return np.cumsum(delta)
+
+#################################################################################
+# Look up the timezone at a location. Coordinates are rounded to 0.1 degree so
+# that nearby lookups share a cache entry
+def _get_tz(lat, lon):
+  return _tz_at(round(lat, 1), round(lon, 1))
+
+@functools.lru_cache(maxsize=64)
+def _tz_at(lat, lon):
+  global tzf
+  if tzf is None:
+    from timezonefinder import TimezoneFinder
+    tzf = TimezoneFinder()
+  return dateutil.tz.gettz(tzf.timezone_at(lng=lon, lat=lat))
 
 #################################################################################
 # Parse the file and set up a pandas table that will be used for processing
 def read_gpx(filename):
-  # Read all the points from all tracks in the GPX file
-  points = []
-  for file in [filename]:
-    gpx_file = open(filename, 'r')
-    gpx = gpxpy.parse(gpx_file)
-    print(f"parsed file: {filename}")
-
-    for segment in gpx.tracks[0].segments: # all segments
-      data = segment.points
-      for point in data:
-        points.append({'lon': point.longitude, 
-                       'lat' : point.latitude, 
-                       'alt' : point.elevation, 
-                       'timestamp' : point.time})
-        #print(points)
-  print(f"processed {len(points)} points")
-
-  if len(points) == 0:
+  # Stream the points of the first track in the GPX file into one list per field
+  lon, lat, alt, timestamps = [], [], [], []
+  # open the file here, so it is closed when reading stops after the first track
+  with open(filename, 'rb') as gpx_file:
+    for _, elem in etree.iterparse(gpx_file, events=('end',), 
+                                   tag=('{*}trkpt', '{*}trk')):
+      if etree.QName(elem).localname == 'trk':
+        break # all segments of the first track have been read
+      lon.append(float(elem.get('lon')))
+      lat.append(float(elem.get('lat')))
+      # look up children by name, so comments and processing instructions are skipped
+      [ele, ts] = [elem.findtext('{*}ele'), elem.findtext('{*}time')]
+      alt.append(np.nan if ele is None else float(ele))
+      timestamps.append(ts)
+      # free points that have been read, so the tree never holds the whole file
+      elem.clear()
+      while elem.getprevious() is not None:
+        del elem.getparent()[0]
+  print(f"parsed file: {filename}")
+  n = len(timestamps)
+  print(f"processed {n} points")
+
+  if n == 0:
     print("empty track")
     return
 
   # Build a pandas datafrome from the GPS data
   global df
-  df = pd.DataFrame(points, columns=['lon', 'lat', 'alt', 'timestamp'])
-  df = df.sort_values(by=['timestamp'])
-  df = df.reset_index()
+  df = pd.DataFrame({'lon': np.array(lon), 'lat': np.array(lat), 'alt': np.array(alt),
+                     'timestamp': pd.to_datetime(timestamps, utc=True, format='ISO8601')})
+  if not df['timestamp'].is_monotonic_increasing:
+    df = df.sort_values(by=['timestamp'])
+    df = df.reset_index(drop=True)
   #print(df.to_string())
 
-  df.ffill(inplace=True)
-  df.bfill(inplace=True)
-
-  # Create columns with position values shifted one point forwards, to enable
-  # caclulating deltas (below)
-  df['lon-start'] = df['lon']
-  df['lon-start'] = np.roll(df['lon-start'], 1)
-  df['lat-start'] = df['lat']
-  df['lat-start'] = np.roll(df['lat-start'], 1)
-  df['alt-start'] = df['alt']
-  df['alt-start'] = np.roll(df['alt-start'], 1)
-
-  df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True)
-
-  # Calculate point-to-point time and distance deltas into new columns
-  df['elapsed_time'] = df.apply(
-      lambda x: (x['timestamp'] - df['timestamp'].iloc[0]).total_seconds(), 
-      axis=1)
-  df['delta_2d'] = df.apply(
-      lambda x: distance.distance((x['lat-start'], x['lon-start']), 
-                                  (x['lat'], x['lon'])).m, 
-      axis = 1)
-  df['delta_alt'] = df.apply(
-      lambda x: x['alt-start'] - x['alt'], 
-      axis=1)
-  df['delta_3d'] = df.apply(
-      lambda x: sqrt(x['delta_2d']**2 + (x['delta_alt'])**2), 
-      axis=1)
-
-  df.at[0, 'delta_2d'] = 0
-  df.at[0, 'delta_3d'] = 0
-  df.at[0, 'delta_alt'] = 0
-
-  # Accumulate 2d or 3d deltas to calculate cumulative distance at each point
-  distance_tag = 'delta_2d' if use_2d else 'delta_3d'
-  df['elapsed_distance'] = df[distance_tag].cumsum()
-
-  # Create a column with timestamp converted to local time, for reporting
-  #df['ts_local'] = df['timestamp'].dt.tz_convert(tz.tzlocal())
-  tzname = tzf.timezone_at(lng=df['lon'].iloc[0], lat=df['lat'].iloc[0])
-  tz = dateutil.tz.gettz(tzname)
-  df['ts_local'] = df['timestamp'].dt.tz_convert(tz)
+  # Fill in any missing readings from neighboring points
+  if df.isna().to_numpy().any():
+    df.ffill(inplace=True)
+    df.bfill(inplace=True)
+
+  # Calculate elapsed time, and accumulate 2d or 3d point-to-point distances to
+  # calculate cumulative distance at each point. These are kept as arrays for 
+  # the interval search rather than as columns of df
+  global distances, times
+  ts = df['timestamp'].values # datetime64 in UTC
+  times = (ts - ts[0]) / np.timedelta64(1, 's')
+  distances = compute_track(np.radians(df['lat'].to_numpy()),
+                            np.radians(df['lon'].to_numpy()),
+                            df['alt'].to_numpy(), use_2d)
+  global total_distance, total_time
+  [total_distance, total_time] = [distances[-1], times[-1]]
+
+  # Look up the local timezone of the track; timestamps are converted to it
+  # only as needed for reporting
+  global tz
+  tz = _get_tz(df['lat'].iloc[0], df['lon'].iloc[0])
 
   # Report some info from the file
-  filedate = df['ts_local'].iloc[0]
+  filedate = df['timestamp'].iloc[0].tz_convert(tz)
   dtype = '2d' if use_2d else '3d'
   print(f"date: {filedate.strftime('%Y-%m-%d %H:%M:%S%p (UTC%z, %Z)')}")
-  print(f"track distance: ({dtype}): {df['elapsed_distance'].iloc[-1]:.1f} m")
-  print(f"track time: {df['elapsed_time'].iloc[-1]:.1f} sec")
+  print(f"track distance: ({dtype}): {total_distance:.1f} m")
+  print(f"track time: {total_time:.1f} sec")
 
 #################################################################################
-# Find fastest interval equal to or exceeding the given target. Interval can be
-# specified as distance (eg. 1 mi) or time (eg. 1 min)
-def find_best_interval(interval):
-  target_interval = interval.normalize()
+# Since elapsed distance or time (span) never decreases, the first point (j) with
+# at least as much delta span as a target interval from each point (i) can be 
+# found by binary search, for all points and targets at once. Return arrays with
+# the (start, end, speed) of the interval with the best speed for each target,
+# or start=-1 if none.
+def _best_indices(span, dist, tm, targets):
+  n = span.shape[0]
+  k = targets.shape[0]
+  if n < 3 or k == 0:
+    return np.full(k, -1), np.full(k, -1), np.zeros(k)
+  # as in the original scan, intervals don't start at either of the last two points
+  starts = np.arange(n-2)[:, None]
+  ends = np.searchsorted(span, span[:-2, None] + targets[None, :], side='left')
+  ends = np.maximum(ends, starts + 1)
+  # searchsorted tests span[j] >= span[i] + target, which can round differently
+  # from the scan's span[j] - span[i] >= target at exact boundaries. Step the
+  # ends forward or back until they match the subtraction test
+  while True:
+    short = (ends < n) & (span[np.minimum(ends, n-1)] - span[starts] < targets)
+    if not short.any():
+      break
+    ends = ends + short
+  while True:
+    early = (ends - 1 > starts) & (span[ends-1] - span[starts] >= targets)
+    if not early.any():
+      break
+    ends = ends - early
+  valid = ends < n
+  ends = np.where(valid, ends, n-1)
+  with np.errstate(invalid='ignore'):
+    speed = np.divide(dist[ends] - dist[starts], tm[ends] - tm[starts],
+                      out=np.full(ends.shape, -np.inf), where=valid)
+  # a repeated point gives 0/0, which is never a better interval
+  nan = np.isnan(speed)
+  valid &= ~nan
+  speed[nan] = -np.inf
+  best = speed.argmax(axis=0)
+  cols = np.arange(k)
+  found = valid[best, cols]
+  return (np.where(found, best, -1), np.where(found, ends[best, cols], -1),
+          speed[best, cols])
 
-  # Skip if the total distance of the track is smaller then the target
+# Best intervals for distance targets followed by time targets
+def _compute_best_indices(dist, tm, targets_distance, targets_time):
+  by_distance = _best_indices(dist, dist, tm, targets_distance)
+  by_time = _best_indices(tm, dist, tm, targets_time)
+  return tuple(np.concatenate(pair) for pair in zip(by_distance, by_time))
+
+#################################################################################
+# Find fastest intervals equal to or exceeding the given targets. Intervals can be
+# specified as distance (eg. 1 mi) or time (eg. 1 min). All intervals that fit
+# in the track are searched together, then reported in the order given
+def find_best_intervals(intervals):
+  fits = [iv for iv in intervals 
+          if (total_distance if iv.is_distance else total_time) >= iv.normalize()]
+  by_distance = [iv for iv in fits if iv.is_distance]
+  by_time = [iv for iv in fits if not iv.is_distance]
+  best = {}
+  if fits:
+    results = _compute_best_indices(
+        distances, times,
+        np.array([iv.normalize() for iv in by_distance], dtype=float),
+        np.array([iv.normalize() for iv in by_time], dtype=float))
+    best = dict(zip(by_distance + by_time, zip(*results)))
+  for interval in intervals:
+    report_interval(interval, best.get(interval))
+
+#################################################################################
+# Report the best (start, end, speed) found for an interval, or None if the 
+# track is too short for it
+def report_interval(interval, best):
   print(f"\ntarget interval: {interval}:")
-  key = 'elapsed_distance' if interval.is_distance else 'elapsed_time'
-  if df[key].iloc[-1] < target_interval:
+  if best is None:
     print("no intervals found (track too short)")
     return
 
-  # Iterate over points in the track. From each point (i), find the first point (j)
-  # with least as much delta distance or time as the target interval. Record the 
-  # interval with the best speed.
-  best_interval = {'start': None, 'end': None, 'speed': None }
-  j = 1
-  for i in range(len(df.index)-2):
-    j = max(j, i+1)
-    while j < len(df.index):
-      dist = df['elapsed_distance'].iloc[j] - df['elapsed_distance'].iloc[i]
-      elapsed = df['elapsed_time'].iloc[j] - df['elapsed_time'].iloc[i]
-      span = dist if interval.is_distance else elapsed
-      if span < target_interval:
-        j = j + 1
-      else:
-        speed = dist / elapsed
-        if best_interval['start'] is None or speed > best_interval['speed']:
-          best_interval.update({'start': i, 'end': j, 'speed': speed})
-        # note: don't advance j, since [i+1,j] could also be a candidate
-        break
+  [start_idx, end_idx, speed] = best
+  [dist, tm] = [distances, times]
 
   # This should not happen; with a long-enough track there must be at least 
   # one interval
-  if best_interval['start'] is None:
+  if start_idx < 0:
      print("no interval found")
      return
 
   # Report results from the winning interval 
-  [start_idx, end_idx] = [best_interval['start'], best_interval['end']]
-  [start_point, end_point] = [df.loc[start_idx], df.loc[end_idx]]
-  speed = best_interval['speed']
-  distance = end_point['elapsed_distance'] - start_point['elapsed_distance']
-  elapsed = end_point['elapsed_time'] - start_point['elapsed_time']
-
-  print(f"   start: {start_point['ts_local'].strftime('%H:%M:%S')}", end=' ')
-  print(f"(T+{time.strftime('%H:%M:%S', time.gmtime(start_point['elapsed_time']))})", end=' ')
+  [start_time, end_time] = [df['timestamp'].iloc[start_idx].tz_convert(tz),
+                            df['timestamp'].iloc[end_idx].tz_convert(tz)]
+  distance = dist[end_idx] - dist[start_idx]
+  elapsed = tm[end_idx] - tm[start_idx]
+
+  print(f"   start: {start_time.strftime('%H:%M:%S')}", end=' ')
+  print(f"(T+{time.strftime('%H:%M:%S', time.gmtime(tm[start_idx]))})", end=' ')
   print(f"(index={start_idx})")
-  print(f"   end: {end_point['ts_local'].strftime('%H:%M:%S')}", end=' ')
-  print(f"(T+{time.strftime('%H:%M:%S', time.gmtime(end_point['elapsed_time']))})", end=' ')
+  print(f"   end: {end_time.strftime('%H:%M:%S')}", end=' ')
+  print(f"(T+{time.strftime('%H:%M:%S', time.gmtime(tm[end_idx]))})", end=' ')
   print(f"(index={end_idx})")
   print(f"   time: {elapsed:.2f} sec")
   print(f"   distance: {distance:.1f} m ({distance*0.0006213712:.3f} mi)" )